@@ -27,7 +27,7 @@ import subprocess
 import os
 import stat
 import shutil
-from tempfile import mkdtemp
+from tempfile import mkdtemp, mkstemp
 from xml.etree import ElementTree as ET
 import plistlib
 import argparse
@@ -37,6 +37,9 @@ import glob
 import fnmatch
 import io
 import json
+import hashlib
+import gzip
+import codecs
 
 VERSION = "5.6"
 
@@ -97,6 +100,8 @@ ICON_SIZES = [
 
 PKGBUILD = "/usr/bin/pkgbuild"
 PKGUTIL = "/usr/sbin/pkgutil"
+LSBOM = "/usr/bin/lsbom"
+MKBOM = "/usr/bin/mkbom"
 PRODUCTBUILD = "/usr/bin/productbuild"
 PRODUCTSIGN = "/usr/bin/productsign"
 CODESIGN = "/usr/bin/codesign"
@@ -112,6 +117,42 @@ ACTOOL = [
 
 MUNKIURL = "https://api.github.com/repos/munki/munki/releases/latest"
 
+# Component Payload and Scripts archives are gzipped cpio in odc format
+CPIO_MAGIC = b"070707"
+CPIO_HEADER_SIZE = 76
+CPIO_TRAILER = b"TRAILER!!!"
+CPIO_FIELDS = [
+    ("dev", 6),
+    ("ino", 6),
+    ("mode", 6),
+    ("uid", 6),
+    ("gid", 6),
+    ("nlink", 6),
+    ("rdev", 6),
+    ("mtime", 11),
+    ("namesize", 6),
+    ("filesize", 11),
+]
+CHUNK_SIZE = 1024 * 1024
+
+
+def _cksum_table():
+    table = []
+    for i in range(256):
+        c = i << 24
+        for _ in range(8):
+            c = ((c << 1) ^ 0x04C11DB7) if c & 0x80000000 else (c << 1)
+        table.append(c & 0xFFFFFFFF)
+    return table
+
+
+CKSUM_TABLE = _cksum_table()
+
+CACHE_DIR = "/Library/Caches/munki_rebrand"
+# Total size of rebranded pkgs kept in the cache before the least recently
+# used entries are evicted
+CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
 global verbose
 verbose = False
 tmp_dir = mkdtemp()
@@ -154,15 +195,17 @@ def download_pkg(url, output):
     run_cmd(cmd)
 
 
-def flatten_pkg(directory, pkg):
-    """Flattens a pkg folder"""
-    cmd = [PKGUTIL, "--flatten-full", directory, pkg]
+def flatten_pkg(directory, pkg, full=True):
+    """Flattens a pkg folder. Unless full is set, component Payload and
+    Scripts archives are expected to be compressed already"""
+    cmd = [PKGUTIL, "--flatten-full" if full else "--flatten", directory, pkg]
     run_cmd(cmd)
 
 
-def expand_pkg(pkg, directory):
-    """Expands a flat pkg to a folder"""
-    cmd = [PKGUTIL, "--expand-full", pkg, directory]
+def expand_pkg(pkg, directory, full=True):
+    """Expands a flat pkg to a folder. Unless full is set, component
+    Payload and Scripts archives are left compressed"""
+    cmd = [PKGUTIL, "--expand-full" if full else "--expand", pkg, directory]
     run_cmd(cmd)
 
 
@@ -191,28 +234,254 @@ def is_binary(f):
     else:
         return False
 
-def replace_strings(strings_file, code, appname):
-    """Replaces localized app name in a .strings file with desired app name"""
+def rebrand_line(line, localized, appname):
+    """Replaces localized app name in a line of a .strings file"""
+    # We want to only replace on the right hand side of any =
+    # and we don't want to do it to a comment
+    if "=" in line and not line.startswith("/*"):
+        left, right = line.split("=")
+        right = right.replace(localized, appname)
+        line = "=".join([left, right])
+    return line
+
+
+def strings_edit(code, appname):
+    """Returns an edit which replaces localized app name in the contents of
+    a .strings file with desired app name"""
     localized = APPNAME_LOCALIZED[code]
-    if verbose:
-        print(f"Replacing '{localized}' in {strings_file} with '{appname}'...")
-    backup_file = f"{strings_file}.bak"
-    enc = guess_encoding(strings_file)
-
-    # Could do this in place but im oldskool so
-    with io.open(backup_file, "w", encoding=enc) as fw, io.open(
-        strings_file, "r", encoding=enc
-    ) as fr:
-        for line in fr:
-            # We want to only replace on the right hand side of any =
-            # and we don't want to do it to a comment
-            if "=" in line and not line.startswith("/*"):
-                left, right = line.split("=")
-                right = right.replace(localized, appname)
-                line = "=".join([left, right])
-            fw.write(line)
-    os.remove(strings_file)
-    os.rename(backup_file, strings_file)
+
+    def edit(data):
+        # Leave compiled .strings files alone
+        if data.startswith(b"bplist"):
+            return data
+        if data.startswith(codecs.BOM_UTF16_LE):
+            enc = "utf-16-le"
+        elif data.startswith(codecs.BOM_UTF16_BE):
+            enc = "utf-16-be"
+        else:
+            enc = "utf-8"
+        # Only split lines on \n and \r, as reading the file as text would
+        lines = io.StringIO(data.decode(enc), newline="")
+        rebranded = "".join(rebrand_line(line, localized, appname) for line in lines)
+        return rebranded.encode(enc)
+
+    return edit
+
+
+def app_payload_edits(paths, appname, icon_file=None, car=None):
+    """Works out the changes needed to rebrand the apps in the app component's
+    Payload, given the paths it contains. Returns a dict of paths to edits and
+    a dict of paths to files their contents should be replaced with"""
+    edits = {}
+    replacements = {}
+    for app in APPS:
+        resources = f"./{app['path']}/Contents/Resources/"
+        for path in paths:
+            if not path.startswith(resources):
+                continue
+            parts = path[len(resources) :].split("/")
+            # Determine lang code
+            code = parts[0].split(".")[0]
+            # Don't try to change anything we don't know about
+            if (
+                len(parts) > 1
+                and parts[0].endswith(".lproj")
+                and code in APPNAME_LOCALIZED
+                and fnmatch.fnmatch(path, "*.strings")
+            ):
+                if verbose:
+                    print(f"Replacing '{APPNAME_LOCALIZED[code]}' in {path}...")
+                edits[path] = strings_edit(code, appname)
+        if icon_file:
+            icon_path = next(
+                (resources + icon for icon in app["icon"] if resources + icon in paths),
+                None,
+            )
+            if icon_path:
+                print(f"Replacing icons in {icon_path} with {icon_file}...")
+                replacements[icon_path] = icon_file
+        if car and resources + "Assets.car" in paths:
+            print(f"Replacing icons in {resources}Assets.car with {car}...")
+            replacements[resources + "Assets.car"] = car
+    return edits, replacements
+
+
+def payload_paths(directory):
+    """Returns the paths in an expanded Payload, in the same form as lsbom"""
+    paths = {"."}
+    for root, dirs, files in os.walk(directory):
+        for name in dirs + files:
+            rel = os.path.relpath(os.path.join(root, name), directory)
+            paths.add(f"./{rel}")
+    return paths
+
+
+def apply_edits(directory, edits=None, replacements=None):
+    """Applies the edits and replacements returned by app_payload_edits to an
+    expanded Payload. Anything other than a regular file is left alone"""
+    for path, edit in (edits or {}).items():
+        dest = os.path.join(directory, path)
+        if os.path.islink(dest) or not os.path.isfile(dest):
+            continue
+        with open(dest, "rb") as f:
+            data = edit(f.read())
+        with open(dest, "wb") as f:
+            f.write(data)
+    for path, source in (replacements or {}).items():
+        dest = os.path.join(directory, path)
+        if os.path.islink(dest) or not os.path.isfile(dest):
+            continue
+        shutil.copyfile(source, dest)
+
+
+def apply_additions(directory, additions):
+    """Copies (source, mode) additions into an expanded Scripts directory"""
+    for path, (source, mode) in additions.items():
+        dest = os.path.join(directory, path)
+        shutil.copyfile(source, dest)
+        os.chmod(dest, mode)
+
+
+def cksum(data):
+    """Returns the POSIX cksum CRC of data, as recorded in Bom files"""
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CKSUM_TABLE[(crc >> 24) ^ byte]
+    length = len(data)
+    while length:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CKSUM_TABLE[(crc >> 24) ^ (length & 0xFF)]
+        length >>= 8
+    return ~crc & 0xFFFFFFFF
+
+
+def is_streamable(archive):
+    """Checks if an archive is a gzipped odc cpio archive which can be
+    rewritten in flight"""
+    try:
+        with gzip.open(archive, "rb") as f:
+            return f.read(len(CPIO_MAGIC)) == CPIO_MAGIC
+    except OSError:
+        return False
+
+
+def read_cpio_header(f):
+    """Reads an odc cpio header and filename, returning them as a dict"""
+    raw = f.read(CPIO_HEADER_SIZE)
+    if len(raw) != CPIO_HEADER_SIZE or not raw.startswith(CPIO_MAGIC):
+        raise ValueError("Malformed cpio header")
+    header = {}
+    offset = len(CPIO_MAGIC)
+    for field, width in CPIO_FIELDS:
+        header[field] = int(raw[offset : offset + width], 8)
+        offset += width
+    header["name"] = f.read(header["namesize"])[:-1]
+    return header
+
+
+def write_cpio_header(f, header):
+    """Writes an odc cpio header and filename"""
+    header["namesize"] = len(header["name"]) + 1
+    f.write(CPIO_MAGIC)
+    for field, width in CPIO_FIELDS:
+        f.write(f"{header[field]:0{width}o}".encode())
+    f.write(header["name"] + b"\0")
+
+
+def rewrite_archive(archive, edits=None, replacements=None, additions=None):
+    """Streams a gzipped cpio archive into a new one, applying changes in
+    flight. edits maps archive paths to functions which are passed a file's
+    contents and return its new contents. replacements maps archive paths to
+    files whose contents should replace them. additions maps archive paths to
+    (source file, mode) tuples of files to add, replacing any existing file at
+    that path. Only regular files are changed; other entries are copied
+    through. Ownership is set to root:admin throughout. Only changed files are
+    held in memory. Returns a dict of changed paths to their new
+    (size, checksum)"""
+    edits = edits or {}
+    replacements = replacements or {}
+    additions = dict(additions or {})
+    modified = {}
+    new_archive = f"{archive}.new"
+    with gzip.open(archive, "rb") as fr, gzip.open(new_archive, "wb") as fw:
+        while True:
+            header = read_cpio_header(fr)
+            name = header["name"]
+            if name == CPIO_TRAILER:
+                break
+            path = name.decode("utf-8", "surrogateescape")
+            header["uid"], header["gid"] = 0, 80
+            is_file = stat.S_ISREG(header["mode"])
+            if path in additions and not is_file:
+                raise ValueError(f"Can't replace non-file {path} in {archive}")
+            if path in additions:
+                source, mode = additions.pop(path)
+                with open(source, "rb") as f:
+                    data = f.read()
+                fr.seek(header["filesize"], io.SEEK_CUR)
+                header["mode"] = stat.S_IFREG | mode
+                header["mtime"] = int(os.stat(source).st_mtime)
+            elif is_file and path in replacements:
+                with open(replacements[path], "rb") as f:
+                    data = f.read()
+                fr.seek(header["filesize"], io.SEEK_CUR)
+            elif is_file and path in edits:
+                data = edits[path](fr.read(header["filesize"]))
+            else:
+                write_cpio_header(fw, header)
+                remaining = header["filesize"]
+                while remaining:
+                    chunk = fr.read(min(remaining, CHUNK_SIZE))
+                    if not chunk:
+                        raise ValueError(f"Truncated cpio entry {path}")
+                    fw.write(chunk)
+                    remaining -= len(chunk)
+                continue
+            modified[path] = (len(data), cksum(data))
+            header["filesize"] = len(data)
+            write_cpio_header(fw, header)
+            fw.write(data)
+        for path, (source, mode) in additions.items():
+            with open(source, "rb") as f:
+                data = f.read()
+            header = dict(
+                dev=0,
+                ino=0,
+                mode=stat.S_IFREG | mode,
+                uid=0,
+                gid=80,
+                nlink=1,
+                rdev=0,
+                mtime=int(os.stat(source).st_mtime),
+                name=path.encode("utf-8", "surrogateescape"),
+                filesize=len(data),
+            )
+            modified[path] = (len(data), cksum(data))
+            write_cpio_header(fw, header)
+            fw.write(data)
+        trailer = dict.fromkeys((field for field, _ in CPIO_FIELDS), 0)
+        trailer.update(nlink=1, name=CPIO_TRAILER)
+        write_cpio_header(fw, trailer)
+    os.rename(new_archive, archive)
+    return modified
+
+
+def list_bom(bom):
+    """Returns the lines of lsbom output for a Bom, split into fields"""
+    return [line.split("\t") for line in run_cmd([LSBOM, bom], ret=True).splitlines()]
+
+
+def update_bom(bom, modified):
+    """Rewrites a Bom to match a Payload rewritten by rewrite_archive"""
+    bom_list = f"{bom}.txt"
+    with open(bom_list, "w") as f:
+        for fields in list_bom(bom):
+            fields[2] = "0/80"
+            if fields[0] in modified:
+                fields[3:5] = [str(x) for x in modified[fields[0]]]
+            f.write("\t".join(fields) + "\n")
+    os.remove(bom)
+    run_cmd([MKBOM, "-i", bom_list, bom])
+    os.remove(bom_list)
 
 
 def icon_test(png):
@@ -357,6 +626,136 @@ def is_signable_lib(path):
     return False
 
 
+def file_hash(path):
+    """Returns the sha256 hex digest of a file, or None if it doesn't exist"""
+    if not path or not os.path.isfile(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def dir_hash(path):
+    """Returns the sha256 hex digest of the paths and contents of every file
+    in a directory tree, or None if it doesn't exist"""
+    if not os.path.isdir(path):
+        return None
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file_ in sorted(files):
+            fpath = os.path.join(root, file_)
+            h.update(os.path.relpath(fpath, path).encode())
+            h.update(file_hash(fpath).encode())
+    return h.hexdigest()
+
+
+def tool_version(tool):
+    """Returns the --version output of a tool, or None if it can't be run"""
+    try:
+        proc = subprocess.run([tool, "--version"], capture_output=True)
+    except OSError:
+        return None
+    if proc.returncode != 0:
+        return None
+    return proc.stdout.rstrip().decode()
+
+
+def build_fingerprint(args, actool):
+    """Returns a key identifying every input which affects the output pkg"""
+    inputs = {
+        # Hash ourselves rather than trusting VERSION to change with the code
+        "script": file_hash(os.path.abspath(__file__)),
+        "pkg": file_hash(args.pkg),
+        "appname": args.appname,
+        "icon_file": file_hash(args.icon_file),
+        "identifier": args.identifier,
+        "postinstall": file_hash(args.postinstall),
+        "resource_addition": file_hash(args.resource_addition),
+        "resource_addition_name": args.resource_addition
+        and os.path.basename(args.resource_addition),
+        "sign_package": args.sign_package,
+        "sign_binaries": args.sign_binaries,
+        "stream_payloads": args.stream_payloads,
+    }
+    # actool and Assets.xcassets only affect the output when building icons
+    if inputs["icon_file"] and actool:
+        rebrand_dir = os.path.dirname(os.path.abspath(__file__))
+        inputs["actool"] = actool
+        inputs["actool_version"] = tool_version(actool)
+        inputs["xcassets"] = dir_hash(os.path.join(rebrand_dir, "Assets.xcassets"))
+    canonical = json.dumps(inputs, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def cache_lookup(key):
+    """Returns (pkg path, munki version) of a cached build, or None"""
+    entry = os.path.join(CACHE_DIR, key)
+    try:
+        with open(os.path.join(entry, "info.json")) as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    pkg = os.path.join(entry, "munkitools.pkg")
+    munki_version = info.get("munki_version")
+    if not munki_version or not os.path.isfile(pkg):
+        return None
+    # Mark entry as recently used for eviction purposes
+    os.utime(entry)
+    return pkg, munki_version
+
+
+def cache_store(key, pkg, munki_version):
+    """Copies a finished pkg into the cache and evicts old entries"""
+    entry = os.path.join(CACHE_DIR, key)
+    # Write to temp files and move them into place so that an overlapping
+    # run never sees a partial entry. info.json goes last as it marks the
+    # entry complete
+    tmp_pkg = tmp_info = None
+    try:
+        os.makedirs(entry, exist_ok=True)
+        fd, tmp_pkg = mkstemp(dir=entry)
+        os.close(fd)
+        shutil.copyfile(pkg, tmp_pkg)
+        os.replace(tmp_pkg, os.path.join(entry, "munkitools.pkg"))
+        fd, tmp_info = mkstemp(dir=entry)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"munki_version": munki_version}, f)
+        os.replace(tmp_info, os.path.join(entry, "info.json"))
+    except OSError as e:
+        print(f"WARNING: could not cache {pkg}: {e}")
+        for tmp in tmp_pkg, tmp_info:
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+        return
+    cache_evict()
+
+
+def cache_evict(max_size=CACHE_MAX_SIZE):
+    """Removes least recently used cache entries until under max_size"""
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        entry = os.path.join(CACHE_DIR, name)
+        if not os.path.isdir(entry):
+            continue
+        size = sum(
+            os.path.getsize(os.path.join(root, file_))
+            for root, dirs, files in os.walk(entry)
+            for file_ in files
+        )
+        entries.append((os.path.getmtime(entry), size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        if verbose:
+            print(f"Evicting {entry} from cache...")
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
 def main():
     p = argparse.ArgumentParser(
         description="Rebrands Munki's Managed Software "
@@ -430,6 +829,18 @@ def main():
         "Provide the certificate's Common Name. e.g.: "
         "'Developer ID Application  Munki (U8PN57A5N2)'",
     ),
+    p.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always rebuild the pkg, ignoring and not updating previously "
+        f"built pkgs stored in {CACHE_DIR}",
+    )
+    p.add_argument(
+        "--stream-payloads",
+        action="store_true",
+        help="Experimental: rewrite component payloads in flight rather than "
+        "expanding them to disk. Can't be used with --sign-binaries",
+    )
     p.add_argument("-v", "--verbose", action="store_true", help="Be more verbose"),
     p.add_argument(
         "-x", "--version", action="store_true", help="Print version and exit"
@@ -462,11 +873,7 @@ def main():
         )
 
     if args.icon_file and os.path.isfile(args.icon_file):
-        if icon_test(args.icon_file):
-            # Attempt to convert png to icns
-            print("Converting .png file to .icns...")
-            icns, car = convert_to_icns(args.icon_file, tmp_dir, actool=actool)
-        else:
+        if not icon_test(args.icon_file):
             print("ERROR: icon file must be a 1024x1024 .png")
             sys.exit(1)
 
@@ -481,9 +888,43 @@ def main():
         args.pkg = output
 
     if args.pkg and os.path.isfile(args.pkg):
+        # Identical inputs produce an identical pkg, so reuse a previous build
+        cache_key = None
+        if not args.no_cache:
+            cache_key = build_fingerprint(args, actool)
+            cached = cache_lookup(cache_key)
+            if cached:
+                cached_pkg, munki_version = cached
+                final_pkg = os.path.join(
+                    os.getcwd(), f"{outfilename}-{munki_version}.pkg"
+                )
+                print(f"Found cached build, copying {cached_pkg} to {final_pkg}...")
+                shutil.copyfile(cached_pkg, final_pkg)
+                return
+
+        icns = car = None
+        if args.icon_file and os.path.isfile(args.icon_file):
+            # Attempt to convert png to icns
+            print("Converting .png file to .icns...")
+            icns, car = convert_to_icns(args.icon_file, tmp_dir, actool=actool)
+
         pkg_id_prefix = args.identifier
         root_dir = os.path.join(tmp_dir, "root")
-        expand_pkg(args.pkg, root_dir)
+        stream = args.stream_payloads
+        if stream and args.sign_binaries:
+            # Binaries can only be signed once expanded to disk
+            print("WARNING: --stream-payloads can't be used with --sign-binaries")
+            stream = False
+        if stream:
+            expand_pkg(args.pkg, root_dir, full=False)
+            archives = glob.glob(os.path.join(root_dir, "*.pkg", "Payload"))
+            archives += glob.glob(os.path.join(root_dir, "*.pkg", "Scripts"))
+            if not all(is_streamable(archive) for archive in archives):
+                print("Payloads can't be rewritten in flight, expanding to disk...")
+                shutil.rmtree(root_dir)
+                stream = False
+        if not stream:
+            expand_pkg(args.pkg, root_dir)
 
         # Grab just the first match of this glob to get the app pkg regardless
         # of version number
@@ -507,71 +948,56 @@ def main():
         core_payload = os.path.join(core_pkg, "Payload")
         python_payload = os.path.join(python_pkg, "Payload")
 
+        app_additions = {}
         if args.postinstall and os.path.isfile(args.postinstall):
-            dest = os.path.join(app_scripts, "postinstall")
-            print(f"Copying postinstall script {args.postinstall} to {dest}...")
-            shutil.copyfile(args.postinstall, dest)
-            print(f"Making {dest} executable...")
-            os.chmod(dest, 0o755)
-
+            print(f"Adding postinstall script {args.postinstall}...")
+            app_additions["./postinstall"] = (args.postinstall, 0o755)
         if args.resource_addition and os.path.isfile(args.resource_addition):
-            destination = app_scripts
             source = args.resource_addition
-            print(f"Adding additional resource {source} to {destination}...")
-            try:
-                shutil.copy(source, destination)
-            except shutil.SameFileError:
-                print("Source and destination represents the same file.")
-            # If there is any permission issue
-            except PermissionError:
-                print("Permission denied.")
-            # For other errors
-            except:
-                print("Error occurred while copying file.")
-
-
-        # Find the lproj directories in the apps' Resources dirs
+            print(f"Adding additional resource {source}...")
+            app_additions[f"./{os.path.basename(source)}"] = (
+                source,
+                stat.S_IMODE(os.stat(source).st_mode),
+            )
+        if app_additions and not os.path.exists(app_scripts):
+            print(f"ERROR: {app_pkg} has no Scripts to add files to")
+            sys.exit(1)
+
         print(f"Replacing app name with {args.appname}...")
-        for app in APPS:
-            app_dir = os.path.join(app_payload, app["path"])
-            resources_dir = os.path.join(app_dir, "Contents/Resources")
-            # Get a list of all the lproj dirs in each app's Resources dir
-            lproj_dirs = glob.glob(os.path.join(resources_dir, "*.lproj"))
-            for lproj_dir in lproj_dirs:
-                # Determine lang code
-                code = os.path.basename(lproj_dir).split(".")[0]
-                # Don't try to change anything we don't know about
-                if code in list(APPNAME_LOCALIZED.keys()):
-                    for root, dirs, files in os.walk(lproj_dir):
-                        for file_ in files:
-                            lfile = os.path.join(root, file_)
-                            if fnmatch.fnmatch(lfile, "*.strings"):
-                                replace_strings(lfile, code, args.appname)
-            if args.icon_file:
-                if icns:
-                    for icon in app["icon"]:
-                        if os.path.isfile(
-                            os.path.join(
-                                app_payload,
-                                os.path.join(app["path"], "Contents/Resources", icon),
-                            )
-                        ):
-                            found_icon = icon
-                            break
-                    icon_path = os.path.join(
-                        app["path"], "Contents/Resources", found_icon
+        if stream:
+            app_paths = {fields[0] for fields in list_bom(os.path.join(app_pkg, "Bom"))}
+        else:
+            app_paths = payload_paths(app_payload)
+        app_edits, app_replacements = app_payload_edits(
+            app_paths,
+            args.appname,
+            icon_file=args.icon_file if icns else None,
+            car=car,
+        )
+
+        if stream:
+            # Rewrite the compressed component archives in flight rather than
+            # expanding them to disk
+            for pkg in glob.glob(os.path.join(root_dir, "*.pkg")):
+                is_app = pkg == app_pkg
+                payload = os.path.join(pkg, "Payload")
+                scripts = os.path.join(pkg, "Scripts")
+                if os.path.isfile(payload):
+                    if verbose:
+                        print(f"Rewriting {payload}...")
+                    modified = rewrite_archive(
+                        payload,
+                        edits=app_edits if is_app else None,
+                        replacements=app_replacements if is_app else None,
                     )
-                    dest = os.path.join(app_payload, icon_path)
-                    print(f"Replacing icons in {dest} with {args.icon_file}...")
-                    shutil.copyfile(args.icon_file, dest)
-                if car:
-                    car_path = os.path.join(
-                        app["path"], "Contents/Resources", "Assets.car"
+                    update_bom(os.path.join(pkg, "Bom"), modified)
+                if os.path.isfile(scripts):
+                    rewrite_archive(
+                        scripts, additions=app_additions if is_app else None
                     )
-                    dest = os.path.join(app_payload, car_path)
-                    if os.path.isfile(dest):
-                        shutil.copyfile(car, dest)
-                        print(f"Replacing icons in {dest} with {car}...")
+        else:
+            apply_additions(app_scripts, app_additions)
+            apply_edits(app_payload, app_edits, app_replacements)
 
         # Set root:admin throughout payload
         for root, dirs, files in os.walk(root_dir):
@@ -669,9 +1095,11 @@ def main():
 
         final_pkg = os.path.join(os.getcwd(), f"{outfilename}-{munki_version}.pkg")
         print(f"Building output pkg at {final_pkg}...")
-        flatten_pkg(root_dir, final_pkg)
+        flatten_pkg(root_dir, final_pkg, full=not stream)
         if args.sign_package:
             sign_package(args.sign_package, final_pkg)
+        if cache_key:
+            cache_store(cache_key, final_pkg, munki_version)
 
     else:
         print(f"Could not find munkitools pkg {args.pkg}.")
@@ -0,0 +1,268 @@
+"""
+Checks for munki_rebrand's build cache and in-flight Payload rewriting. These
+don't need macOS; the Bom side (lsbom/mkbom) still has to be checked against
+a real munkitools pkg.
+"""
+import argparse
+import gzip
+import os
+import stat
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import munki_rebrand  # noqa: E402
+
+RESOURCES = "./Applications/Managed Software Center.app/Contents/Resources"
+STRINGS = f"{RESOURCES}/en.lproj/Main.strings"
+ICON = f"{RESOURCES}/AppIcon.icns"
+
+
+def make_archive(path, entries):
+    """Writes a gzipped odc cpio archive of (name, mode, data) entries"""
+    with gzip.open(path, "wb") as f:
+        for ino, (name, mode, data) in enumerate(entries, 1):
+            header = dict(
+                dev=1,
+                ino=ino,
+                mode=mode,
+                uid=501,
+                gid=20,
+                nlink=1,
+                rdev=0,
+                mtime=1600000000,
+                name=name.encode(),
+                filesize=len(data),
+            )
+            munki_rebrand.write_cpio_header(f, header)
+            f.write(data)
+        trailer = dict.fromkeys((field for field, _ in munki_rebrand.CPIO_FIELDS), 0)
+        trailer.update(nlink=1, name=munki_rebrand.CPIO_TRAILER)
+        munki_rebrand.write_cpio_header(f, trailer)
+
+
+def read_archive(path):
+    """Returns a dict of names to (header, data) from a gzipped cpio archive"""
+    entries = {}
+    with gzip.open(path, "rb") as f:
+        while True:
+            header = munki_rebrand.read_cpio_header(f)
+            if header["name"] == munki_rebrand.CPIO_TRAILER:
+                return entries
+            entries[header["name"].decode()] = (header, f.read(header["filesize"]))
+
+
+class TestCksum(unittest.TestCase):
+    def test_matches_posix_cksum(self):
+        # Values from coreutils cksum
+        self.assertEqual(munki_rebrand.cksum(b""), 4294967295)
+        self.assertEqual(munki_rebrand.cksum(b"hello\n"), 3015617425)
+        self.assertEqual(munki_rebrand.cksum(bytes(range(256)) * 1000), 2080856851)
+
+
+class TestStringsEdit(unittest.TestCase):
+    def test_utf16_and_line_separators(self):
+        edit = munki_rebrand.strings_edit("en", "Amazing")
+        text = (
+            "\ufeff/* Managed Software Center */\r\n"
+            '"a" = "Managed Software Center\u2028Managed Software Center";\n'
+        )
+        result = edit(text.encode("utf-16-le")).decode("utf-16-le")
+        self.assertEqual(
+            result,
+            '\ufeff/* Managed Software Center */\r\n"a" = "Amazing\u2028Amazing";\n',
+        )
+
+    def test_binary_plist_untouched(self):
+        edit = munki_rebrand.strings_edit("en", "Amazing")
+        data = b"bplist00Managed Software Center"
+        self.assertEqual(edit(data), data)
+
+
+class TestRewriteArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.archive = os.path.join(self.tmp.name, "Payload")
+        self.big = os.urandom(3 * munki_rebrand.CHUNK_SIZE + 7)
+        self.icon = os.path.join(self.tmp.name, "icon.png")
+        with open(self.icon, "wb") as f:
+            f.write(b"new icon")
+        self.script = os.path.join(self.tmp.name, "postinstall")
+        with open(self.script, "wb") as f:
+            f.write(b"#!/bin/sh\n")
+        make_archive(
+            self.archive,
+            [
+                (".", stat.S_IFDIR | 0o755, b""),
+                (STRINGS, stat.S_IFREG | 0o644, b'"a" = "Managed Software Center";\n'),
+                (ICON, stat.S_IFLNK | 0o755, b"Other.icns"),
+                ("./big", stat.S_IFREG | 0o644, self.big),
+            ],
+        )
+
+    def test_round_trip(self):
+        modified = munki_rebrand.rewrite_archive(
+            self.archive,
+            edits={STRINGS: munki_rebrand.strings_edit("en", "Amazing")},
+            replacements={ICON: self.icon},
+            additions={"./postinstall": (self.script, 0o755)},
+        )
+        entries = read_archive(self.archive)
+        self.assertEqual(entries[STRINGS][1], b'"a" = "Amazing";\n')
+        # Symlinks are copied through rather than replaced
+        self.assertEqual(entries[ICON][1], b"Other.icns")
+        self.assertEqual(entries["./big"][1], self.big)
+        header, data = entries["./postinstall"]
+        self.assertEqual(data, b"#!/bin/sh\n")
+        self.assertEqual(header["mode"], stat.S_IFREG | 0o755)
+        for header, _ in entries.values():
+            self.assertEqual((header["uid"], header["gid"]), (0, 80))
+        self.assertEqual(
+            modified,
+            {
+                STRINGS: (17, munki_rebrand.cksum(b'"a" = "Amazing";\n')),
+                "./postinstall": (10, munki_rebrand.cksum(b"#!/bin/sh\n")),
+            },
+        )
+
+    def test_unchanged_archive_round_trip(self):
+        before = read_archive(self.archive)
+        self.assertEqual(munki_rebrand.rewrite_archive(self.archive), {})
+        after = read_archive(self.archive)
+        self.assertEqual(list(before), list(after))
+        for name, (header, data) in before.items():
+            header.update(uid=0, gid=80)
+            self.assertEqual(after[name], (header, data))
+
+
+class TestApplyEdits(unittest.TestCase):
+    def test_expanded_payload(self):
+        with tempfile.TemporaryDirectory() as payload:
+            lproj = os.path.join(payload, os.path.dirname(STRINGS))
+            os.makedirs(lproj)
+            with open(os.path.join(payload, STRINGS), "wb") as f:
+                f.write(b'"a" = "Managed Software Center";\n')
+            os.symlink("Other.icns", os.path.join(payload, ICON))
+            edits, replacements = munki_rebrand.app_payload_edits(
+                munki_rebrand.payload_paths(payload), "Amazing", icon_file=__file__
+            )
+            self.assertEqual(list(edits), [STRINGS])
+            self.assertEqual(replacements, {ICON: __file__})
+            munki_rebrand.apply_edits(payload, edits, replacements)
+            with open(os.path.join(payload, STRINGS), "rb") as f:
+                self.assertEqual(f.read(), b'"a" = "Amazing";\n')
+            self.assertEqual(os.readlink(os.path.join(payload, ICON)), "Other.icns")
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache_dir = os.path.join(self.tmp.name, "cache")
+        os.mkdir(self.cache_dir)
+        patcher = unittest.mock.patch.object(
+            munki_rebrand, "CACHE_DIR", self.cache_dir
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def args(self, **kwargs):
+        defaults = dict(
+            pkg=self.write("munkitools.pkg", b"pkg"),
+            appname="Amazing Software Center",
+            icon_file=None,
+            identifier="com.googlecode.munki",
+            postinstall=None,
+            resource_addition=None,
+            sign_package=None,
+            sign_binaries=None,
+            stream_payloads=False,
+        )
+        defaults.update(kwargs)
+        return argparse.Namespace(**defaults)
+
+    def store(self, key, size, mtime):
+        munki_rebrand.cache_store(key, self.write("out.pkg", b"x" * size), "6.0")
+        os.utime(os.path.join(self.cache_dir, key), (mtime, mtime))
+
+    def test_store_then_lookup_hits(self):
+        pkg = self.write("out.pkg", b"rebranded")
+        munki_rebrand.cache_store("key", pkg, "6.0")
+        cached_pkg, munki_version = munki_rebrand.cache_lookup("key")
+        self.assertEqual(munki_version, "6.0")
+        with open(cached_pkg, "rb") as f:
+            self.assertEqual(f.read(), b"rebranded")
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.cache_dir, "key"))),
+            ["info.json", "munkitools.pkg"],
+        )
+
+    def test_incomplete_entries_miss(self):
+        self.assertIsNone(munki_rebrand.cache_lookup("key"))
+        munki_rebrand.cache_store("key", self.write("out.pkg", b"x"), "6.0")
+        info = os.path.join(self.cache_dir, "key", "info.json")
+        with open(info, "w") as f:
+            f.write("{}")
+        self.assertIsNone(munki_rebrand.cache_lookup("key"))
+        os.remove(info)
+        self.assertIsNone(munki_rebrand.cache_lookup("key"))
+
+    def test_evicts_least_recently_used(self):
+        self.store("old", 100, 1000)
+        self.store("used", 100, 2000)
+        self.store("new", 100, 3000)
+        # Looking an entry up makes it the most recently used
+        self.assertIsNotNone(munki_rebrand.cache_lookup("old"))
+        # Each entry is its pkg plus a small info.json
+        munki_rebrand.cache_evict(max_size=250)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["new", "old"])
+        munki_rebrand.cache_evict(max_size=250)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["new", "old"])
+
+    def test_fingerprint_tracks_inputs(self):
+        icon = self.write("icon.png", b"icon")
+        script = self.write("postinstall", b"#!/bin/sh")
+        resource = self.write("resource", b"resource")
+        args = self.args(icon_file=icon, postinstall=script, resource_addition=resource)
+        key = munki_rebrand.build_fingerprint(args, None)
+        self.assertEqual(key, munki_rebrand.build_fingerprint(args, None))
+        keys = {key}
+        for path, data in [
+            (args.pkg, b"other pkg"),
+            (icon, b"other icon"),
+            (script, b"#!/bin/bash"),
+            (resource, b"other resource"),
+        ]:
+            with open(path, "wb") as f:
+                f.write(data)
+            keys.add(munki_rebrand.build_fingerprint(args, None))
+        renamed = self.write("renamed", b"other resource")
+        args.resource_addition = renamed
+        keys.add(munki_rebrand.build_fingerprint(args, None))
+        self.assertEqual(len(keys), 6)
+
+    def test_fingerprint_ignores_actool_without_icon(self):
+        args = self.args()
+        with unittest.mock.patch.object(munki_rebrand, "tool_version") as version:
+            key = munki_rebrand.build_fingerprint(args, "/usr/bin/actool")
+            version.assert_not_called()
+        self.assertEqual(key, munki_rebrand.build_fingerprint(args, None))
+
+    def test_fingerprint_survives_failing_actool(self):
+        args = self.args(icon_file=self.write("icon.png", b"icon"))
+        self.assertIsNone(munki_rebrand.tool_version("/bin/false"))
+        munki_rebrand.build_fingerprint(args, "/bin/false")
+
+
+if __name__ == "__main__":
+    unittest.main()